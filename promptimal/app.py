@@ -22,6 +22,11 @@ except ImportError:
 #########
 
 
+# Longest line that's diffed character by character (which is O(N*M)) when
+# edited. Longer lines are shown as removed and added instead
+MAX_INLINE_DIFF_LENGTH = 500
+
+
 class ScrollableListBox(urwid.ListBox):
     def keypress(self, size, key):
         if key in ("up", "down", "page up", "page down"):
@@ -40,9 +45,13 @@ class PromptBox:
         self.loop = None  # Parent event loop
 
         # Widgets
+        self._line_widgets: List[urwid.Text] = []  # One per rendered line
+        self._line_markup: List[Tuple[str, str]] = []
         self.prompt_widget = ScrollableListBox(
             urwid.SimpleFocusListWalker(self._create_prompt())
         )
+        # Inputs the prompt widgets were last rendered from
+        self._prompt_cache_key = (self.init_prompt, self.curr_prompt, self.show_diff)
         self.score = urwid.Text(self._create_score())
         self.options = urwid.Text(self._create_options(prompt), align="right")
         menu = urwid.Columns(
@@ -77,7 +86,7 @@ class PromptBox:
             await asyncio.sleep(0.5)
 
     def _create_score(self, score: Optional[float] = None) -> List[Tuple[str, str]]:
-        if score == None:
+        if score is None:
             return ["\n", ("tertiary", "Score: "), ("secondary", "...")]
 
         score_attr = "score ok"
@@ -92,50 +101,86 @@ class PromptBox:
             (score_attr, f"{(score * 100):.2f}%"),
         ]
 
-    def _create_prompt(self, prompt: Optional[str] = None) -> List[Tuple[str, str]]:
+    def _create_prompt_markup(
+        self, prompt: Optional[str] = None
+    ) -> List[Tuple[str, str]]:
         prompt = prompt if prompt else self.curr_prompt
 
         if not self.show_diff or prompt == self.init_prompt:
-            return [urwid.Text(("default", line)) for line in prompt.split("\n")]
-
-        diff = difflib.ndiff(self.init_prompt, prompt)
-        diffed_lines, current_line = [], []
-        for item in diff:
-            code, char = item[0], item[2:]
-
-            if code == " ":  # Unchanged
-                current_line.append(char)
-            elif code == "+":  # Added
-                current_line.append(("diff added", char))
-            elif code == "-":  # Deleted
-                current_line.append(("diff removed", char))
-
-            if char.endswith("\n"):
-                last_char = current_line[-1]
-                if isinstance(last_char, tuple):
-                    last_char = last_char[1]
-
-                if last_char == "\n":
-                    current_line[-1] = ("default", "")
-
-                diffed_lines.append(current_line)
-                current_line = []
-
-        if current_line:
-            diffed_lines.append(current_line)
-
-        diff_widgets = []
-        for line in diffed_lines:
-            last_char = line[-1]
-            if isinstance(last_char, tuple):
-                last_char = last_char[1]
-
-            if last_char == "\n":
-                line[-1] = ("default", "")
-
-            diff_widgets.append(urwid.Text(line))
-
-        return diff_widgets
+            return [("default", line) for line in prompt.split("\n")]
+
+        # Line-level diff, so unchanged lines are rendered as-is
+        init_lines, lines = self.init_prompt.split("\n"), prompt.split("\n")
+        matcher = difflib.SequenceMatcher(None, init_lines, lines, autojunk=False)
+        markup = []
+        for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+            if tag == "equal":
+                markup.extend(("default", line) for line in lines[j1:j2])
+                continue
+
+            # Edited lines are shown inline, if they're similar enough to pair up
+            if tag == "replace" and i2 - i1 == j2 - j1:
+                line_markup = [
+                    self._create_line_diff_markup(init_line, line)
+                    for init_line, line in zip(init_lines[i1:i2], lines[j1:j2])
+                ]
+                if all(line_markup):
+                    markup.extend(line_markup)
+                    continue
+
+            if tag in ("replace", "delete"):
+                markup.extend(("diff removed", line) for line in init_lines[i1:i2])
+            if tag in ("replace", "insert"):
+                markup.extend(("diff added", line) for line in lines[j1:j2])
+
+        return markup
+
+    def _create_line_diff_markup(
+        self, init_line: str, line: str
+    ) -> Optional[List[Tuple[str, str]]]:
+        if max(len(init_line), len(line)) > MAX_INLINE_DIFF_LENGTH:
+            return None
+
+        # Too different to be worth diffing inline. The cheap upper bounds on
+        # the ratio are checked first
+        matcher = difflib.SequenceMatcher(None, init_line, line, autojunk=False)
+        if (
+            matcher.real_quick_ratio() < 0.5
+            or matcher.quick_ratio() < 0.5
+            or matcher.ratio() < 0.5
+        ):
+            return None
+
+        # One (attr, text) run per opcode, rather than one per character
+        markup = []
+        for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+            if tag == "equal":
+                markup.append(("default", line[j1:j2]))
+                continue
+
+            if tag in ("replace", "delete"):
+                markup.append(("diff removed", init_line[i1:i2]))
+            if tag in ("replace", "insert"):
+                markup.append(("diff added", line[j1:j2]))
+
+        return markup
+
+    def _create_prompt(self, prompt: Optional[str] = None) -> List[urwid.Text]:
+        markup = self._create_prompt_markup(prompt)
+        if markup == self._line_markup:
+            return self._line_widgets
+
+        # Reuse the existing line widgets, only touching the lines that changed
+        for index, line in enumerate(markup):
+            if index >= len(self._line_widgets):
+                self._line_widgets.append(urwid.Text(line))
+            elif line != self._line_markup[index]:
+                self._line_widgets[index].set_text(line)
+
+        del self._line_widgets[len(markup) :]
+        self._line_markup = markup
+
+        return self._line_widgets
 
     def _create_options(self, prompt: str) -> List[Tuple[str, str]]:
         options = [
@@ -163,32 +208,40 @@ class PromptBox:
 
         return options
 
+    def _set_prompt_widgets(self, widgets: List[urwid.Text]):
+        # Replace the walker's contents in place, keeping the scroll position
+        body = self.prompt_widget.body
+        focus = body.focus or 0
+        body[:] = widgets
+        if widgets:
+            body.set_focus(min(focus, len(widgets) - 1))
+
     def update(
         self,
         prompt: Optional[str] = None,
         score: Optional[float] = None,
         show_diff: Optional[bool] = None,
     ):
-        if score != None:
+        if score is not None:
             if self.loading_task:
                 self.loading_task.cancel()
                 self.loading_task = None
 
             self.score.set_text(self._create_score(score))
 
-        if prompt != None:
+        if prompt is not None and prompt != self.curr_prompt:
             self.curr_prompt = prompt
-            self.prompt_widget.body[:] = urwid.SimpleFocusListWalker(
-                self._create_prompt()
-            )
             self.options.set_text(self._create_options(prompt))
 
-        if show_diff != None:
+        if show_diff is not None and show_diff != self.show_diff:
             self.show_diff = show_diff
-            self.prompt_widget.body[:] = urwid.SimpleFocusListWalker(
-                self._create_prompt()
-            )
-            self.options.set_text(self._create_options(prompt))
+            self.options.set_text(self._create_options(self.curr_prompt))
+
+        # Re-diffing is expensive, so only re-render when the inputs changed
+        prompt_cache_key = (self.init_prompt, self.curr_prompt, self.show_diff)
+        if prompt_cache_key != self._prompt_cache_key:
+            self._prompt_cache_key = prompt_cache_key
+            self._set_prompt_widgets(self._create_prompt())
 
     async def run(self, loop: urwid.AsyncioEventLoop):
         self.loop = loop
@@ -299,6 +352,9 @@ class App:
         self.is_finished = False
         self.prompt = init_prompt
         self.score = None
+        self._last_update = 0.0  # Monotonic time of the last widget update
+        self._pending_update = False  # Whether state changed since then
+        self._dirty = False  # Whether widgets changed since the last redraw
         self.steps = [
             ProgressStep(
                 index=0,
@@ -350,7 +406,24 @@ class App:
         self.prompt_box.update(self.prompt, self.score)
         self.progress_box.update(self.steps)
         self.footer.update(self.steps)
-        self.loop.draw_screen()
+        self._dirty = True  # Drawn on the next flush
+
+    def _flush_draw(self, loop: urwid.MainLoop, user_data=None):
+        # Updates widgets at most 10 times per second (always including the
+        # latest step), and redraws at most once per tick
+        now = time.monotonic()
+        if self._pending_update and (
+            now - self._last_update >= 0.1 or self.is_finished
+        ):
+            self._pending_update = False
+            self._last_update = now
+            self.update()
+
+        if self._dirty:
+            self._dirty = False
+            loop.draw_screen()
+
+        loop.set_alarm_in(0.05, self._flush_draw)
 
     def handle_input(self, key: str):
         if key in ("q", "Q", "esc"):
@@ -365,7 +438,9 @@ class App:
     async def optimize(self, **kwargs):
         async for step in optimize(self.prompt, **kwargs):
             # Update state
-            self.prompt = step.best_prompt.replace("\\n", "\n")
+            self.prompt = step.best_prompt
+            if "\\n" in self.prompt:
+                self.prompt = self.prompt.replace("\\n", "\n")
             self.score = step.best_score
             existing_step = next((s for s in self.steps if s.index == step.index), None)
             if existing_step:
@@ -377,9 +452,10 @@ class App:
             else:
                 self.steps.append(step)
 
-            # # Update widgets and yield control to event loop
-            self.update()
-            await asyncio.sleep(0)
+            # Widgets are updated on the next flush, so that bursts of steps are
+            # coalesced. No need to yield to the event loop here, the optimizer
+            # already does while awaiting the LLM
+            self._pending_update = True
 
         self.is_finished = True
 
@@ -387,6 +463,7 @@ class App:
         asyncio.ensure_future(self.prompt_box.run(self.loop))
         asyncio.ensure_future(self.progress_box.run(self.loop))
         asyncio.ensure_future(self.optimize(**kwargs))
+        self.loop.set_alarm_in(0.05, self._flush_draw)
 
         self.loop.run()
 
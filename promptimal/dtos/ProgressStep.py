@@ -9,7 +9,7 @@ except ImportError:
     from dtos.TokenCount import TokenCount
 
 
-@dataclass
+@dataclass(slots=True)
 class ProgressStep:
     index: int
     message: str
@@ -3,7 +3,7 @@ from dataclasses import dataclass
 from typing import Optional
 
 
-@dataclass
+@dataclass(slots=True)
 class PromptCandidate:
     prompt: str
     fitness: Optional[float] = None
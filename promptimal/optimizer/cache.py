@@ -0,0 +1,141 @@
+# Standard library
+import os
+import json
+import hashlib
+import logging
+from typing import Dict, Tuple, Type
+
+# Third party
+from pydantic import BaseModel
+
+try:
+    import orjson  # Optional, (de)serializes cache entries several times faster
+except ImportError:
+    orjson = None
+
+# Local
+try:
+    from promptimal.dtos import TokenCount
+    from promptimal.optimizer.parallel_dispatcher import (
+        record_usage,
+        request_semaphore,
+        throttle,
+    )
+except ImportError:
+    from dtos import TokenCount
+    from optimizer.parallel_dispatcher import (
+        record_usage,
+        request_semaphore,
+        throttle,
+    )
+
+
+logger = logging.getLogger("promptimal.cache")
+
+CACHE_DIR = os.getenv(
+    "PROMPTIMAL_CACHE_DIR",
+    os.path.join(
+        os.getenv("XDG_CACHE_HOME") or os.path.expanduser("~/.cache"), "promptimal"
+    ),
+)
+
+# Whether cached results are read from and written to disk. Turned off with
+# PROMPTIMAL_NO_CACHE (or --no_cache), for a fresh run on the same inputs
+use_disk_cache = not os.getenv("PROMPTIMAL_NO_CACHE")
+
+# Responses seen during this run, so repeat requests skip the disk as well
+_memory_cache: Dict[str, dict] = {}
+
+
+def _get_cache_path(**kwargs) -> str:
+    payload = json.dumps(kwargs, sort_keys=True, ensure_ascii=False)
+    key = hashlib.sha256(payload.encode("utf-8")).hexdigest()
+    return os.path.join(CACHE_DIR, f"{key}.json")
+
+
+def disable_disk_cache():
+    global use_disk_cache
+    use_disk_cache = False
+
+
+def read_cache_file(path: str):
+    if not use_disk_cache:
+        return None
+
+    try:
+        with open(path, "rb") as file:
+            return load_json(file.read())
+    except (OSError, ValueError):
+        return None  # Nothing cached yet, or unreadable
+
+
+def write_cache_file(path: str, data: bytes):
+    # Caching is best-effort, so an unwritable cache dir mustn't end the run
+    if not use_disk_cache:
+        return
+
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "wb") as file:
+            file.write(data)
+    except OSError as e:
+        logger.warning("Couldn't write to the cache (%s)", e)
+
+
+def load_json(data: bytes):
+    return orjson.loads(data) if orjson else json.loads(data)
+
+
+def dump_json(obj) -> bytes:
+    if orjson:
+        return orjson.dumps(obj)
+
+    return json.dumps(obj, ensure_ascii=False).encode("utf-8")
+
+
+def _get_token_count(response: BaseModel) -> TokenCount:
+    token_usage = getattr(response, "usage", None)
+    if token_usage:
+        return TokenCount(token_usage.prompt_tokens, token_usage.completion_tokens)
+
+    return TokenCount(0, 0)
+
+
+async def cached_completion(
+    client, response_model: Type[BaseModel], sample: int = 0, **kwargs
+) -> Tuple[BaseModel, TokenCount]:
+    """
+    Calls `client.chat.completions.create` through a persistent, on-disk response
+    cache. Requests are keyed by their full payload plus a sample index, so that
+    repeated self-consistency samples don't collapse into a single cached answer.
+    Entries are also kept in memory for the rest of the run. Cache hits cost
+    nothing and are reported as zero tokens.
+    """
+    cache_path = _get_cache_path(
+        response_model=response_model.model_json_schema(), sample=sample, **kwargs
+    )
+
+    cached_response = _memory_cache.get(cache_path)
+    if cached_response is None:
+        cached_response = read_cache_file(cache_path)
+
+    if cached_response is not None:
+        try:
+            response = response_model.model_validate(cached_response)
+            _memory_cache[cache_path] = cached_response
+            return response, TokenCount(0, 0)
+        except ValueError:
+            pass  # Stale entry, fall through and overwrite it
+
+    async with request_semaphore:
+        await throttle()
+        response = await client.chat.completions.create(
+            response_model=response_model, **kwargs
+        )
+    token_count = _get_token_count(response)
+    record_usage(token_count)
+
+    _memory_cache[cache_path] = response.model_dump()
+    write_cache_file(cache_path, dump_json(_memory_cache[cache_path]))
+
+    return response, token_count
@@ -1,31 +1,70 @@
 # Standard library
 import os
 import time
-import asyncio
-from typing import Optional
+from heapq import nlargest
+from operator import attrgetter
+from typing import Callable, Dict, List, Optional
 
 # Third party
-from google.genai import Client
+import httpx
+from google.genai import Client, types
+
+try:
+    import h2  # Optional, lets concurrent requests share one HTTP/2 connection
+
+    HTTP2 = True
+except ImportError:
+    HTTP2 = False
 
 # Local
 try:
     from promptimal.optimizer.utils import (
         crossover,
-        evaluate_fitness,
+        evaluate_population,
         init_population,
-        select_parent,
+        select_parents,
     )
+    from promptimal.optimizer.parallel_dispatcher import RateLimiter, dispatch
+    from promptimal.optimizer.semantic_cache import save_semantic_caches
     from promptimal.dtos import ProgressStep, PromptCandidate, TokenCount
 except ImportError:
     from optimizer.utils import (
         crossover,
-        evaluate_fitness,
+        evaluate_population,
         init_population,
-        select_parent,
+        select_parents,
     )
+    from optimizer.parallel_dispatcher import RateLimiter, dispatch
+    from optimizer.semantic_cache import save_semantic_caches
     from dtos import ProgressStep, PromptCandidate, TokenCount
 
 
+# Clients are shared across runs so their connection pools stay warm
+_clients: Dict[str, Client] = {}
+
+
+def get_client(api_key: str) -> Client:
+    if api_key not in _clients:
+        _clients[api_key] = Client(
+            api_key=api_key,
+            http_options=types.HttpOptions(
+                timeout=120_000,  # Milliseconds
+                # The default httpx pool is too small for a whole generation of
+                # concurrent requests
+                async_client_args={
+                    "http2": HTTP2,
+                    "limits": httpx.Limits(
+                        max_connections=128,
+                        max_keepalive_connections=64,
+                        keepalive_expiry=300,
+                    ),
+                },
+            ),
+        )
+
+    return _clients[api_key]
+
+
 async def optimize(
     prompt: str,  # First version of the prompt
     improvement_request: Optional[str] = None,  # Description of what to improve
@@ -34,103 +73,120 @@ async def optimize(
     num_elites: int = 2,  # No. of top candidates to pass onto the next generation
     threshold: float = 1.0,
     api_key: str = "",
-    evaluator: Optional[callable] = None,
+    evaluator: Optional[Callable] = None,
+    max_concurrency: int = 16,  # Max. no. of candidates evaluated/bred at once
+    rpm_limit: int = 500,  # Max. no. of LLM requests per minute
+    tpm_limit: int = 200_000,  # Max. no. of LLM tokens per minute
 ):
-    evaluate = evaluate_fitness if not evaluator else evaluator
-    genai = Client(api_key=os.getenv("GOOGLE_AI_API_KEY", api_key))
+    genai = get_client(api_key or os.getenv("GOOGLE_AI_API_KEY", ""))
     start_time = time.time()
 
-    best_candidate = initial_prompt = PromptCandidate(prompt)
+    rate_limiter = RateLimiter(rpm_limit, tpm_limit)
+
+    def evaluation_tasks(population: List[PromptCandidate]) -> list:
+        # Identical prompts (e.g. repeated by the LLM, or by crossover) only
+        # need to be evaluated once
+        duplicates: Dict[str, List[PromptCandidate]] = {}
+        for candidate in population:
+            duplicates.setdefault(candidate.prompt.strip(), []).append(candidate)
+        unique = [candidates[0] for candidates in duplicates.values()]
+
+        async def fan_out(task):
+            candidates, token_count = await task
+            evaluated = []
+            for candidate in candidates:
+                for duplicate in duplicates[candidate.prompt.strip()]:
+                    duplicate.fitness = candidate.fitness
+                    duplicate.reflection = candidate.reflection
+                    evaluated.append(duplicate)
+
+            return evaluated, token_count
+
+        # The LLM judge scores the whole population in one batched request,
+        # whereas custom evaluators score one candidate at a time
+        if not evaluator:
+            task = evaluate_population(
+                unique,
+                prompt,
+                improvement_request,
+                genai,
+                # Stop sampling candidates that can't beat the best so far
+                cutoff=best_candidate.fitness,
+            )
+            return [fan_out(task)]
+
+        async def evaluate(candidate: PromptCandidate):
+            candidate, token_count = await evaluator(
+                candidate, prompt, improvement_request, genai
+            )
+            return [candidate], token_count
+
+        return [fan_out(evaluate(candidate)) for candidate in unique]
+
+    best_candidate = PromptCandidate(prompt)
     token_count = TokenCount(0, 0)
+    num_prompts = 0
 
-    yield ProgressStep(
-        index=0,
-        value=0.125,
-        message="Starting optimization",
-        best_prompt=prompt,
-        token_count=token_count,
-        start_time=start_time,
-    )
+    def step(index: int, message: str, value: Optional[float] = None, **kwargs):
+        # Progress step carrying a snapshot of the current optimization state
+        return ProgressStep(
+            index=index,
+            message=message,
+            value=value,
+            best_prompt=best_candidate.prompt,
+            best_score=best_candidate.fitness,
+            token_count=token_count,
+            num_prompts=num_prompts,
+            start_time=start_time,
+            **kwargs,
+        )
+
+    message = "Starting optimization"
+    yield step(0, message, 0.125)
 
     population, _token_count = await init_population(
         prompt, improvement_request, population_size, genai
     )
     token_count += _token_count
-    num_prompts = 0
 
-    yield ProgressStep(
-        index=0,
-        value=0.25,
-        message="Starting optimization",
-        best_prompt=best_candidate.prompt,
-        token_count=token_count,
-        start_time=start_time,
-    )
+    yield step(0, message, 0.25)
 
-    tasks = [
-        evaluate(candidate, improvement_request, initial_prompt, genai)
-        for candidate in population
-    ]
-    for index, task in enumerate(asyncio.as_completed(tasks)):
-        candidate, _token_count = await task
+    tasks = evaluation_tasks(population)
+    for index, task in enumerate(dispatch(tasks, rate_limiter, max_concurrency)):
+        candidates, _token_count = await task
         token_count += _token_count
-        num_prompts += 1
+        num_prompts += len(candidates)
 
-        if candidate.prompt == best_candidate.prompt:
-            best_candidate = candidate
-            initial_prompt = candidate
+        for candidate in candidates:
+            if candidate.prompt == best_candidate.prompt:
+                best_candidate = candidate
 
-        yield ProgressStep(
-            index=0,
-            value=0.25 + (0.75 * (index + 1) / len(tasks)),
-            message="Starting optimization",
-            best_prompt=best_candidate.prompt,
-            best_score=best_candidate.fitness,
-            token_count=token_count,
-            num_prompts=num_prompts,
-            start_time=start_time,
+        yield step(
+            0,
+            message,
+            0.25 + (0.75 * (index + 1) / len(tasks)),
             end_time=time.time() if index == len(tasks) - 1 else None,
         )
 
     for index in range(num_iters):
         start_time = time.time()
-        yield ProgressStep(
-            index=index + 1,
-            value=0.0,
-            message=f"Iteration #{index + 1}/{num_iters}",
-            best_prompt=best_candidate.prompt,
-            best_score=best_candidate.fitness,
-            token_count=token_count,
-            num_prompts=num_prompts,
-            start_time=start_time,
-        )
+        message = f"Iteration {index + 1}/{num_iters}"
+        yield step(index + 1, message, 0.0)
 
         # Evaluate fitness of each candidate
-        tasks = [
-            evaluate(candidate, initial_prompt, improvement_request, genai)
-            for candidate in population
-        ]
-        for i, task in enumerate(asyncio.as_completed(tasks)):
-            _, _token_count = await task
+        tasks = evaluation_tasks(population)
+        for i, task in enumerate(dispatch(tasks, rate_limiter, max_concurrency)):
+            candidates, _token_count = await task
             token_count += _token_count
-            num_prompts += 1 if index > 0 else 0
-
-            yield ProgressStep(
-                index=index + 1,
-                value=0.25 * ((i + 1) / len(tasks)),
-                message=f"Iteration {index + 1}/{num_iters}",
-                best_prompt=best_candidate.prompt,
-                best_score=best_candidate.fitness,
-                token_count=token_count,
-                num_prompts=num_prompts,
-                start_time=start_time,
-            )
+            num_prompts += len(candidates) if index > 0 else 0
 
-        # Sort population by fitness
-        population.sort(key=lambda candidate: candidate.fitness, reverse=True)
+            yield step(index + 1, message, 0.25 * ((i + 1) / len(tasks)))
+
+        # Pick the fittest candidates (no need to sort the whole population)
+        elites = nlargest(max(num_elites, 1), population, key=attrgetter("fitness"))
 
         # Update the best individual
-        generation_best = population[0]
+        generation_best = elites[0]
         if (
             not best_candidate.fitness
             or generation_best.fitness > best_candidate.fitness
@@ -139,59 +195,38 @@ async def optimize(
 
         # Terminate if a candidate meets the fitness threshold
         if best_candidate.fitness >= threshold:
-            yield ProgressStep(
-                index=index + 1,
-                value=1.0,
-                message=f"Iteration {index + 1}/{num_iters}",
-                best_prompt=best_candidate.prompt,
-                best_score=best_candidate.fitness,
-                token_count=token_count,
-                num_prompts=num_prompts,
-                start_time=start_time,
-                end_time=time.time(),
-            )
+            yield step(index + 1, message, 1.0, end_time=time.time())
             break
 
         # Generate the new population
-        mates = (
-            (select_parent(population), select_parent(population))
-            for _ in range(population_size - num_elites)
-        )
+        parents = select_parents(population, 2 * (population_size - num_elites))
+        mates = zip(parents[::2], parents[1::2])
         tasks = [
             crossover(
-                *parents,
+                *pair,
                 initial_prompt=prompt,
                 improvement_request=improvement_request,
                 genai=genai,
             )
-            for parents in mates
+            for pair in mates
         ]
         children = []
-        for i, task in enumerate(asyncio.as_completed(tasks)):
+        for i, task in enumerate(dispatch(tasks, rate_limiter, max_concurrency)):
             child, _token_count = await task
             token_count += _token_count
 
-            yield ProgressStep(
-                index=index + 1,
-                value=0.25 + ((i + 1) / len(tasks)) * 0.75,
-                message=f"Iteration {index + 1}/{num_iters}",
-                best_prompt=best_candidate.prompt,
-                best_score=best_candidate.fitness,
-                token_count=token_count,
-                num_prompts=num_prompts,
-                start_time=start_time,
+            yield step(
+                index + 1,
+                message,
+                0.25 + ((i + 1) / len(tasks)) * 0.75,
                 end_time=time.time() if i == len(tasks) - 1 else None,
             )
             children.append(child)
 
-        population = population[:num_elites] + children
+        population = elites[:num_elites] + children
 
-    yield ProgressStep(
-        index=index + 2,
-        message="Optimization complete! 🧬",
-        best_prompt=best_candidate.prompt,
-        best_score=best_candidate.fitness,
-        token_count=token_count,
-        num_prompts=num_prompts,
-        is_terminal=True,
-    )
+        # Saved as the run goes, so results survive quitting early
+        save_semantic_caches()
+
+    save_semantic_caches()
+    yield step(index + 2, "Optimization complete! 🧬", is_terminal=True)
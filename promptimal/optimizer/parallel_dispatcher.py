@@ -0,0 +1,100 @@
+# Standard library
+import os
+import time
+import asyncio
+from contextvars import ContextVar
+from typing import Awaitable, Iterable, Iterator, Optional
+
+# Local
+try:
+    from promptimal.dtos import TokenCount
+except ImportError:
+    from dtos import TokenCount
+
+
+class RateLimiter:
+    """
+    Token buckets for requests-per-minute and tokens-per-minute limits, modeled
+    on openai-cookbook's `api_request_parallel_processor.py`. Both buckets refill
+    continuously. Since a request's token usage is only known once it completes,
+    tokens are debited afterwards and new requests wait while the bucket is empty.
+    """
+
+    def __init__(self, rpm_limit: int, tpm_limit: int):
+        self.rpm_limit = rpm_limit
+        self.tpm_limit = tpm_limit
+        self.available_requests = float(rpm_limit)
+        self.available_tokens = float(tpm_limit)
+        self.last_update = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        elapsed_minutes = (now - self.last_update) / 60
+        self.last_update = now
+
+        self.available_requests = min(
+            self.rpm_limit, self.available_requests + elapsed_minutes * self.rpm_limit
+        )
+        self.available_tokens = min(
+            self.tpm_limit, self.available_tokens + elapsed_minutes * self.tpm_limit
+        )
+
+    async def acquire(self):
+        while True:
+            self._refill()
+            if self.available_requests >= 1 and self.available_tokens > 0:
+                self.available_requests -= 1
+                return
+
+            # Sleep until the emptier bucket has refilled enough
+            wait_minutes = max(
+                (1 - self.available_requests) / self.rpm_limit,
+                -self.available_tokens / self.tpm_limit,
+            )
+            await asyncio.sleep(max(wait_minutes * 60, 0.01))
+
+    def record(self, token_count: TokenCount):
+        self.available_tokens -= token_count.input + token_count.output
+
+
+# Caps the number of LLM requests in flight at once, across all tasks (each
+# task may fan out into several requests, e.g. self-consistency samples)
+request_semaphore = asyncio.Semaphore(int(os.getenv("PROMPTIMAL_CONCURRENCY", "8")))
+
+# Limiter for the LLM requests made by the task currently being dispatched
+_rate_limiter: ContextVar[Optional[RateLimiter]] = ContextVar(
+    "rate_limiter", default=None
+)
+
+
+async def throttle():
+    rate_limiter = _rate_limiter.get()
+    if rate_limiter:
+        await rate_limiter.acquire()
+
+
+def record_usage(token_count: TokenCount):
+    rate_limiter = _rate_limiter.get()
+    if rate_limiter:
+        rate_limiter.record(token_count)
+
+
+def dispatch(
+    coros: Iterable[Awaitable],
+    rate_limiter: Optional[RateLimiter] = None,
+    max_concurrency: int = 16,
+) -> Iterator[Awaitable]:
+    """
+    Runs coroutines concurrently, with at most `max_concurrency` in flight, and
+    returns their results in order of completion (like `asyncio.as_completed`).
+    Every LLM request they make is throttled by `rate_limiter`.
+    """
+    semaphore = asyncio.Semaphore(max_concurrency)
+
+    async def run(coro: Awaitable):
+        # Each task runs in its own copy of the context, so this is task-local
+        _rate_limiter.set(rate_limiter)
+        async with semaphore:
+            return await coro
+
+    return asyncio.as_completed([run(coro) for coro in coros])
@@ -1,5 +1,8 @@
 # Prompts inspired by https://github.com/hinthornw/promptimizer and the PromptBreeder paper
 
+# Standard library
+from functools import lru_cache
+
 INIT_POPULATION_PROMPT = """You are an expert AI prompt engineer. You will be given a prompt and your job is to come up with {population_size} better prompts. The user wants to improve the following about the given prompt:
 
 <improvement_request>
@@ -19,19 +22,18 @@ Your improved prompts must:
 
 You MUST generate {population_size} prompts that are better than the provided prompt."""
 
-CROSSOVER_PROMPT = """You are an expert AI prompt engineer tasked with improving the following prompt:
 
-<initial_prompt>
-{initial_prompt}
-</initial_prompt>
+@lru_cache(maxsize=32)
+def get_init_population_prompt(population_size: int, improvement_request: str) -> str:
+    # The other prompts are static, so this is the only template that's filled in
+    return INIT_POPULATION_PROMPT.format(
+        population_size=population_size, improvement_request=improvement_request
+    )
 
-The user would like to improve the following about the prompt:
 
-<improvement_request>
-{improvement_request}
-</improvement_request>
+CROSSOVER_PROMPT = """You are an expert AI prompt engineer tasked with improving a prompt. You will be given the initial prompt, inside <initial_prompt> tags, and what the user would like to improve about it, inside <improvement_request> tags.
 
-Using this information above, your job is to generate a better prompt by combining elements from two prompts that are known to be successful.
+Using this information, your job is to generate a better prompt by combining elements from two prompts that are known to be successful.
 
 The goal is to create a prompt that is better than either of the original prompts, while still staying true to the intent of the initial prompt and the improvement request.
 
@@ -51,19 +53,9 @@ The improved prompt must:
 
 Output both your step-by-step analysis and the improved prompt."""
 
-EVAL_PROMPT = """You are an expert AI prompt engineer tasked with improving the following prompt:
-
-<initial_prompt>
-{initial_prompt}
-</initial_prompt>
-
-The user would like to improve the following about the prompt:
-
-<improvement_request>
-{improvement_request}
-</improvement_request>
+EVAL_PROMPT = """You are an expert AI prompt engineer tasked with improving a prompt. You will be given the initial prompt, inside <initial_prompt> tags, and what the user would like to improve about it, inside <improvement_request> tags.
 
-Using this information above, your job is to evaluate a potentially improved prompt given to you.
+Using this information, your job is to evaluate a potentially improved prompt given to you.
 
 You should grade the prompt in the following categories:
 - **Clarity:** Precisely defines the task with unambiguous language.
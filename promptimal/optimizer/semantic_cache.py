@@ -0,0 +1,188 @@
+# Standard library
+import os
+import math
+import base64
+import hashlib
+import logging
+from array import array
+from collections import OrderedDict
+from typing import Dict, List, Optional, Tuple
+
+# Third party
+from google import genai
+
+# Local
+try:
+    from promptimal.optimizer.cache import (
+        CACHE_DIR,
+        dump_json,
+        read_cache_file,
+        write_cache_file,
+    )
+    from promptimal.dtos import TokenCount
+    from promptimal.optimizer.parallel_dispatcher import (
+        record_usage,
+        request_semaphore,
+        throttle,
+    )
+except ImportError:
+    from optimizer.cache import (
+        CACHE_DIR,
+        dump_json,
+        read_cache_file,
+        write_cache_file,
+    )
+    from dtos import TokenCount
+    from optimizer.parallel_dispatcher import (
+        record_usage,
+        request_semaphore,
+        throttle,
+    )
+
+logger = logging.getLogger("promptimal.cache")
+
+EMBEDDING_MODEL = "text-embedding-004"
+SIMILARITY_THRESHOLD = 0.98
+MAX_ENTRIES = 256  # Max. no. of results kept per context
+
+
+class SemanticCache:
+    """
+    Maps prompt embeddings to previously computed results. A lookup hits when a
+    stored embedding's cosine similarity with the query exceeds the threshold,
+    which catches prompts that only differ by whitespace or trivial rewording.
+    Only the `max_entries` most recently added (or hit) results are kept.
+    """
+
+    def __init__(
+        self, threshold: float = SIMILARITY_THRESHOLD, max_entries: int = MAX_ENTRIES
+    ):
+        self.threshold = threshold
+        self.max_entries = max_entries
+        self.vectors: List[List[float]] = []  # Unit-normalized, oldest first
+        self.values: List[tuple] = []
+        self.exact: OrderedDict[str, tuple] = OrderedDict()  # Need no embedding
+        self.is_dirty = False  # Whether it changed since it was last saved
+
+    def get(self, text: str) -> Optional[tuple]:
+        value = self.exact.get(text)
+        if value is not None:
+            self.exact.move_to_end(text)
+
+        return value
+
+    def lookup(self, vector: Optional[List[float]]) -> Optional[tuple]:
+        if vector is None:
+            return None
+
+        best_similarity, best_index = self.threshold, None
+        for index, cached_vector in enumerate(self.vectors):
+            similarity = sum(a * b for a, b in zip(cached_vector, vector))
+            if similarity > best_similarity:
+                best_similarity, best_index = similarity, index
+
+        if best_index is None:
+            return None
+
+        # Move to the end, so it's evicted last
+        self.vectors.append(self.vectors.pop(best_index))
+        self.values.append(self.values.pop(best_index))
+        return self.values[-1]
+
+    def add(
+        self, vector: Optional[List[float]], value: tuple, text: Optional[str] = None
+    ):
+        if vector is not None:
+            self.vectors.append(vector)
+            self.values.append(value)
+            del self.vectors[: -self.max_entries], self.values[: -self.max_entries]
+        if text is not None:
+            self.exact[text] = value
+            self.exact.move_to_end(text)
+            while len(self.exact) > self.max_entries:
+                self.exact.popitem(last=False)
+
+        self.is_dirty = True
+
+
+def _encode_vector(vector: List[float]) -> str:
+    # As float32 bytes, which is several times smaller than JSON numbers
+    return base64.b64encode(array("f", vector).tobytes()).decode()
+
+
+def _decode_vector(data: str) -> List[float]:
+    return array("f", base64.b64decode(data)).tolist()
+
+
+# Results are only reusable within the same context (e.g. scores from the same
+# model, for the same initial prompt and improvement request), so each context
+# gets its own cache, saved in its own file
+_caches: Dict[Tuple[str, ...], SemanticCache] = {}
+
+
+def _get_cache_path(context: Tuple[str, ...]) -> str:
+    key = hashlib.sha256(dump_json(list(context))).hexdigest()
+    return os.path.join(CACHE_DIR, "semantic", f"{key}.json")
+
+
+def _load_cache(context: Tuple[str, ...]) -> SemanticCache:
+    cache = SemanticCache()
+    entry = read_cache_file(_get_cache_path(context))
+    if entry:
+        try:
+            cache.vectors = [_decode_vector(v) for v in entry["vectors"]]
+            cache.values = [tuple(value) for value in entry["values"]]
+            cache.exact.update((k, tuple(v)) for k, v in entry["exact"])
+        except (KeyError, TypeError, ValueError):
+            return SemanticCache()  # Unreadable, start over
+
+    return cache
+
+
+def get_semantic_cache(*context: str) -> SemanticCache:
+    # Loaded lazily, so only the contexts this run uses are read
+    cache = _caches.get(context)
+    if cache is None:
+        cache = _caches[context] = _load_cache(context)
+
+    return cache
+
+
+def save_semantic_caches():
+    """
+    Persists the semantic caches that changed since they were last saved, so
+    later runs can reuse them.
+    """
+    for context, cache in _caches.items():
+        if not cache.is_dirty:
+            continue
+
+        entry = {
+            "vectors": [_encode_vector(vector) for vector in cache.vectors],
+            "values": cache.values,
+            "exact": list(cache.exact.items()),
+        }
+        write_cache_file(_get_cache_path(context), dump_json(entry))
+        cache.is_dirty = False
+
+
+async def embed(text: str, genai: genai.Client) -> Optional[List[float]]:
+    """
+    Returns the unit-normalized embedding of `text`, or None if it can't be
+    embedded. Embeddings are only used for cache lookups, so a failure here is
+    just a cache miss.
+    """
+    try:
+        async with request_semaphore:
+            await throttle()
+            response = await genai.aio.models.embed_content(
+                model=EMBEDDING_MODEL, contents=text
+            )
+    except Exception as e:
+        logger.warning("Couldn't embed prompt for the semantic cache (%s)", e)
+        return None
+
+    record_usage(TokenCount(len(text) // 4, 0))  # No usage reported, so estimate
+    vector = response.embeddings[0].values
+    norm = math.sqrt(sum(value * value for value in vector)) or 1.0
+    return [value / norm for value in vector]
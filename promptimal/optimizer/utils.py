@@ -1,27 +1,43 @@
+import os
+import math
 import random
-from statistics import mean
-from typing import List, Tuple
+import asyncio
+import logging
+from typing import Any, Callable, Dict, List, Optional, Tuple
 import instructor
 from pydantic import BaseModel, Field
 
 # Local
 try:
     from promptimal.dtos import PromptCandidate, TokenCount
+    from promptimal.optimizer.cache import cached_completion
+    from promptimal.optimizer.semantic_cache import embed, get_semantic_cache
     from promptimal.optimizer.prompts import (
-        INIT_POPULATION_PROMPT,
         EVAL_PROMPT,
         CROSSOVER_PROMPT,
+        get_init_population_prompt,
     )
 except ImportError:
     from dtos import PromptCandidate, TokenCount
+    from optimizer.cache import cached_completion
+    from optimizer.semantic_cache import embed, get_semantic_cache
     from optimizer.prompts import (
-        INIT_POPULATION_PROMPT,
         EVAL_PROMPT,
         CROSSOVER_PROMPT,
+        get_init_population_prompt,
     )
 
 from google import genai
 
+logger = logging.getLogger("promptimal.optimizer")
+
+# Scoring is a simpler task than writing prompts, so a cheaper model will do
+MODEL = os.getenv("PROMPTIMAL_MODEL", "gemini-2.0-flash")
+EVAL_MODEL = os.getenv("PROMPTIMAL_EVAL_MODEL", "gemini-2.0-flash-lite")
+
+# Max. no. of prompts to ask for in a single request, when initializing
+PROMPTS_PER_REQUEST = 5
+
 
 # Pydantic models for structured output
 class BetterPrompts(BaseModel):
@@ -37,121 +53,391 @@ class PromptEvaluation(BaseModel):
     )
 
 
+class CandidateEvaluation(PromptEvaluation):
+    id: int = Field(description="The id of the prompt being evaluated.")
+
+
+class PopulationEvaluation(BaseModel):
+    evaluations: List[CandidateEvaluation] = Field(
+        description="One evaluation for each of the provided prompts."
+    )
+
+
 class PromptCrossover(BaseModel):
     analysis: str = Field(description="Your step-by-step analysis of the two prompts.")
     prompt: str = Field(description="The combined and improved prompt.")
 
 
+# Patched clients, keyed by the id() of the genai client they wrap
+_client_cache: Dict[int, Any] = {}
+
+
+def get_instructor_client(genai: genai.Client):
+    # Patching is costly enough to matter with many concurrent calls, so do it
+    # once per genai client
+    client = _client_cache.get(id(genai))
+    if client is None:
+        client = instructor.from_genai(genai, use_async=True)
+        _client_cache[id(genai)] = client
+
+    return client
+
+
+def get_context_message(initial_prompt: str, improvement_request: str) -> dict:
+    # Kept out of the system message so that the (static) system prompt forms a
+    # stable prefix across calls, which the provider can cache
+    return {
+        "role": "user",
+        "content": f"<initial_prompt>\n{initial_prompt}\n</initial_prompt>\n\n<improvement_request>\n{improvement_request}\n</improvement_request>",
+    }
+
+
+# Probability of wrongly abandoning a candidate that would have beaten the cutoff
+EARLY_STOP_DELTA = 0.05
+
+
+def can_exceed(
+    scores: List[float], num_remaining: int, cutoff: Optional[float]
+) -> bool:
+    """
+    Whether the mean score (as a fitness) is still likely to exceed `cutoff`
+    once the remaining samples come in. Remaining scores are bounded by a
+    Hoeffding upper confidence bound on the mean of the scores seen so far,
+    rather than assumed perfect, so hopeless candidates are dropped sooner.
+    """
+    if cutoff is None or not scores and not num_remaining:
+        return True
+
+    best_remaining = 10
+    if scores:
+        slack = 10 * math.sqrt(math.log(1 / EARLY_STOP_DELTA) / (2 * len(scores)))
+        best_remaining = min(10, sum(scores) / len(scores) + slack)
+
+    best_possible = (sum(scores) + best_remaining * num_remaining) / (
+        10 * (len(scores) + num_remaining)
+    )
+    return best_possible > cutoff
+
+
+async def sample_completions(
+    client,
+    num_samples: int,
+    keep_sampling: Callable[[List[BaseModel], int], bool],
+    **kwargs,
+) -> Tuple[List[BaseModel], TokenCount]:
+    """
+    Requests `num_samples` self-consistency samples concurrently. Once
+    `keep_sampling(responses, num_remaining)` returns False, the outstanding
+    samples are cancelled. Failed samples are dropped, unless all of them fail.
+    """
+    tasks = [
+        asyncio.create_task(cached_completion(client, sample=sample, **kwargs))
+        for sample in range(num_samples)
+    ]
+
+    responses, errors = [], []
+    token_count = TokenCount(0, 0)
+    try:
+        for num_done, task in enumerate(asyncio.as_completed(tasks), 1):
+            try:
+                response, _token_count = await task
+            except Exception as error:
+                logger.warning("Dropping a failed sample (%r)", error)
+                errors.append(error)
+                continue
+
+            responses.append(response)
+            token_count += _token_count
+
+            if not keep_sampling(responses, num_samples - num_done):
+                break
+    finally:
+        for task in tasks:
+            task.cancel()
+
+        # Retrieves the outcome of every task, so none is reported as unhandled
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    if not responses and errors:
+        raise errors[0]
+
+    return responses, token_count
+
+
 async def init_population(
     prompt: str, improvement_request: str, population_size: int, genai: genai.Client
 ) -> Tuple[List[PromptCandidate], TokenCount]:
     """
     Initializes a population of candidate prompts.
     """
-    # Create a patched client with instructor
-    client = instructor.from_genai(genai, use_async=True)
-
-    system_message = {
-        "role": "system",
-        "content": INIT_POPULATION_PROMPT.format(
-            population_size=population_size, improvement_request=improvement_request
-        ),
-    }
-    user_message = {
-        "role": "user",
-        "content": f"Generate {population_size} better versions of the following prompt:\n\n<prompt>\n{prompt}\n</prompt>",
-    }
+    # Reuse the candidates generated for a near-identical prompt
+    semantic_cache = get_semantic_cache(
+        "init_population", MODEL, improvement_request, str(population_size)
+    )
+    cached_result = semantic_cache.get(prompt)
+    if not cached_result:
+        vector = await embed(prompt, genai)
+        cached_result = semantic_cache.lookup(vector)
+    if cached_result:
+        prompts = cached_result[0]
+        population = [PromptCandidate(prompt) for prompt in [prompt] + prompts]
+        return population, TokenCount(0, 0)
+
+    client = get_instructor_client(genai)
+
+    async def generate(num_prompts: int, sample: int):
+        system_message = {
+            "role": "system",
+            "content": get_init_population_prompt(num_prompts, improvement_request),
+        }
+        user_message = {
+            "role": "user",
+            "content": f"Generate {num_prompts} better versions of the following prompt:\n\n<prompt>\n{prompt}\n</prompt>",
+        }
+
+        # Use instructor to handle the structured output
+        return await cached_completion(
+            client,
+            sample=sample,
+            messages=[system_message, user_message],
+            model=MODEL,
+            # temperature=1.0,
+            response_model=BetterPrompts,
+        )
 
-    # Use instructor to handle the structured output
-    response = await client.chat.completions.create(
-        messages=[system_message, user_message],
-        model="gemini-2.0-flash",
-        # temperature=1.0,
-        response_model=BetterPrompts,
+    # Long lists in a single response tend to get truncated or repetitive, so
+    # larger populations are split across concurrent requests
+    num_requests = math.ceil(population_size / PROMPTS_PER_REQUEST)
+    batch_sizes = [
+        population_size // num_requests + (index < population_size % num_requests)
+        for index in range(num_requests)
+    ]
+    responses = await asyncio.gather(
+        *(generate(size, sample) for sample, size in enumerate(batch_sizes))
     )
 
+    prompts = [prompt for response, _ in responses for prompt in response.prompts]
+    token_count = TokenCount(0, 0)
+    for _, _token_count in responses:
+        token_count += _token_count
+
+    semantic_cache.add(vector, (prompts,), prompt)
+
     # Directly use the validated model
-    population = [PromptCandidate(prompt) for prompt in response.prompts]
+    population = [PromptCandidate(prompt) for prompt in prompts]
     population = [PromptCandidate(prompt)] + population  # Add initial prompt
 
-    # Get token usage from instructor response
-    token_usage = getattr(response, "usage", None)
-    if token_usage:
-        token_count = TokenCount(
-            token_usage.prompt_tokens, token_usage.completion_tokens
-        )
-    else:
-        token_count = TokenCount(0, 0)
-
     return population, token_count
 
 
 async def evaluate_fitness(
     candidate: PromptCandidate,
-    initial_prompt: PromptCandidate,
+    initial_prompt: str,
     improvement_request: str,
     genai: genai.Client,
     num_samples=5,
+    cutoff: Optional[float] = None,
 ) -> Tuple[PromptCandidate, TokenCount]:
     """
-    Evaluates a prompt candidate using a LLM + self-consistency.
+    Evaluates a prompt candidate using a LLM + self-consistency. Sampling stops
+    early once the candidate can no longer beat a fitness of `cutoff`.
     """
     # Elite, already evaluated from the previous generation
     if candidate.fitness:
         return candidate, TokenCount(0, 0)
 
-    # Create a patched client with instructor
-    client = instructor.from_genai(genai, use_async=True)
+    # Reuse the score of an identical prompt that was already evaluated
+    semantic_cache = get_semantic_cache(EVAL_MODEL, initial_prompt, improvement_request)
+    cached_result = semantic_cache.get(candidate.prompt)
+    if cached_result:
+        candidate.fitness, candidate.reflection = cached_result
+        return candidate, TokenCount(0, 0)
+
+    # Or of a near-identical one
+    vector = await embed(candidate.prompt, genai)
+    cached_result = semantic_cache.lookup(vector)
+    if cached_result:
+        candidate.fitness, candidate.reflection = cached_result
+        return candidate, TokenCount(0, 0)
+
+    client = get_instructor_client(genai)
 
     # Generate `n_samples` self-evaluations
     messages = [
-        {
-            "role": "system",
-            "content": EVAL_PROMPT.format(
-                initial_prompt=initial_prompt,
-                improvement_request=improvement_request,
-            ),
-        },
+        {"role": "system", "content": EVAL_PROMPT},
+        get_context_message(initial_prompt, improvement_request),
         {
             "role": "user",
             "content": f"Evaluate the following prompt:\n\n<prompt>\n{candidate.prompt}\n</prompt>",
         },
     ]
 
-    evaluations = []
-    total_prompt_tokens = 0
-    total_completion_tokens = 0
+    def keep_sampling(evaluations: List[PromptEvaluation], num_remaining: int):
+        scores = [evaluation.score for evaluation in evaluations]
+        return can_exceed(scores, num_remaining, cutoff)
 
     # We need to call the API multiple times to get multiple samples
-    for _ in range(num_samples):
-        eval_response = await client.chat.completions.create(
-            messages=messages,
-            model="gemini-2.0-flash",
-            # temperature=1.0,
-            response_model=PromptEvaluation,
-        )
+    evaluations, token_count = await sample_completions(
+        client,
+        num_samples,
+        keep_sampling,
+        messages=messages,
+        model=EVAL_MODEL,
+        # temperature=1.0,
+        response_model=PromptEvaluation,
+    )
+
+    # Consolidate results
+    scores = [evaluation.score for evaluation in evaluations]
+    candidate.fitness = sum(scores) / (len(scores) * 10)
+    candidate.reflection = evaluations[0].evaluation  # 1st evaluation is best
+    semantic_cache.add(
+        vector, (candidate.fitness, candidate.reflection), candidate.prompt
+    )
+
+    return candidate, token_count
+
+
+async def evaluate_population(
+    population: List[PromptCandidate],
+    initial_prompt: str,
+    improvement_request: str,
+    genai: genai.Client,
+    num_samples=5,
+    cutoff: Optional[float] = None,
+) -> Tuple[List[PromptCandidate], TokenCount]:
+    """
+    Evaluates every unscored candidate in a population with a single batched
+    LLM request (per self-consistency sample), rather than one request each.
+    Sampling stops early once no candidate can beat a fitness of `cutoff`.
+    """
+    # Elites are already evaluated from the previous generation, and identical
+    # prompts may have been evaluated before that
+    semantic_cache = get_semantic_cache(EVAL_MODEL, initial_prompt, improvement_request)
+    pending = []
+    for candidate in population:
+        if candidate.fitness:
+            continue
+
+        cached_result = semantic_cache.get(candidate.prompt)
+        if cached_result:
+            candidate.fitness, candidate.reflection = cached_result
+        else:
+            pending.append(candidate)
+
+    if not pending:
+        return population, TokenCount(0, 0)
+
+    # Reuse the scores of near-identical prompts that were already evaluated
+    vectors = await asyncio.gather(*(embed(c.prompt, genai) for c in pending))
+    unscored = []
+    for candidate, vector in zip(pending, vectors):
+        cached_result = semantic_cache.lookup(vector)
+        if cached_result:
+            candidate.fitness, candidate.reflection = cached_result
+        else:
+            unscored.append((candidate, vector))
+
+    if not unscored:
+        return population, TokenCount(0, 0)
+
+    client = get_instructor_client(genai)
+
+    prompts = "\n\n".join(
+        f"<prompt id={index}>\n{candidate.prompt}\n</prompt>"
+        for index, (candidate, _) in enumerate(unscored)
+    )
+    messages = [
+        {"role": "system", "content": EVAL_PROMPT},
+        get_context_message(initial_prompt, improvement_request),
+        {
+            "role": "user",
+            "content": f"Evaluate each of the following prompts independently:\n\n{prompts}",
+        },
+    ]
 
-        evaluations.append(eval_response)
+    def group_by_id(
+        responses: List[PopulationEvaluation],
+    ) -> Dict[int, List[CandidateEvaluation]]:
+        evaluations = {index: [] for index in range(len(unscored))}
+        for response in responses:
+            for evaluation in response.evaluations:
+                if evaluation.id in evaluations:
+                    evaluations[evaluation.id].append(evaluation)
+
+        return evaluations
+
+    def keep_sampling(responses: List[PopulationEvaluation], num_remaining: int):
+        return any(
+            can_exceed([e.score for e in evaluations], num_remaining, cutoff)
+            for evaluations in group_by_id(responses).values()
+        )
 
-        # Accumulate token usage
-        token_usage = getattr(eval_response, "usage", None)
-        if token_usage:
-            total_prompt_tokens += token_usage.prompt_tokens
-            total_completion_tokens += token_usage.completion_tokens
+    # We need to call the API multiple times to get multiple samples
+    responses, token_count = await sample_completions(
+        client,
+        num_samples,
+        keep_sampling,
+        messages=messages,
+        model=EVAL_MODEL,
+        # temperature=1.0,
+        response_model=PopulationEvaluation,
+    )
+    evaluations = group_by_id(responses)
 
     # Consolidate results
-    candidate.fitness = mean(eval_response.score for eval_response in evaluations) / 10
-    candidate.reflection = evaluations[0].evaluation  # 1st evaluation is best
+    for index, (candidate, vector) in enumerate(unscored):
+        if not evaluations[index]:
+            # The model skipped this prompt, so score it on its own
+            _, _token_count = await evaluate_fitness(
+                candidate,
+                initial_prompt,
+                improvement_request,
+                genai,
+                num_samples,
+                cutoff,
+            )
+            token_count += _token_count
+            continue
+
+        scores = [evaluation.score for evaluation in evaluations[index]]
+        candidate.fitness = sum(scores) / (len(scores) * 10)
+        candidate.reflection = evaluations[index][0].evaluation  # 1st is best
+        semantic_cache.add(
+            vector, (candidate.fitness, candidate.reflection), candidate.prompt
+        )
 
-    return candidate, TokenCount(total_prompt_tokens, total_completion_tokens)
+    return population, token_count
 
 
-def select_parent(
-    population: List[PromptCandidate], tournament_size=3
-) -> PromptCandidate:
-    tournament = random.sample(population, tournament_size)
+def select_parents(
+    population: List[PromptCandidate], num_parents: int, tournament_size=3
+) -> List[PromptCandidate]:
+    """
+    Runs `num_parents` tournaments at once, looking fitnesses up only once.
+    Parents come in pairs of mates, and the second of each pair is drawn from
+    the candidates with a different prompt than the first, if there are any.
+    """
     # Use a default value of 0.0 if fitness is None
-    return max(tournament, key=lambda candidate: candidate.fitness or 0.0)
+    fitnesses = [candidate.fitness or 0.0 for candidate in population]
+    indices = range(len(population))
+
+    def tournament(entrants) -> int:
+        size = min(tournament_size, len(entrants))
+        return max(random.sample(entrants, size), key=fitnesses.__getitem__)
+
+    parents = []
+    for _ in range(0, num_parents, 2):
+        first = tournament(indices)
+        others = [
+            index
+            for index in indices
+            if population[index].prompt != population[first].prompt
+        ]
+        second = tournament(others or indices)
+        parents += [population[first], population[second]]
+
+    return parents[:num_parents]
 
 
 async def crossover(
@@ -161,35 +447,36 @@ async def crossover(
     improvement_request: str,
     genai: genai.Client,
 ) -> Tuple[PromptCandidate, TokenCount]:
-    # Create a patched client with instructor
-    client = instructor.from_genai(genai, use_async=True)
-
-    system_message = {
-        "role": "system",
-        "content": CROSSOVER_PROMPT.format(
-            initial_prompt=initial_prompt, improvement_request=improvement_request
-        ),
-    }
+    # Reuse the child of a near-identical pair of parents (in either order)
+    semantic_cache = get_semantic_cache(
+        "crossover", MODEL, initial_prompt, improvement_request
+    )
+    parents = "\n\n".join(sorted([parent1.prompt, parent2.prompt]))
+    cached_result = semantic_cache.get(parents)
+    if not cached_result:
+        vector = await embed(parents, genai)
+        cached_result = semantic_cache.lookup(vector)
+    if cached_result:
+        return PromptCandidate(cached_result[0]), TokenCount(0, 0)
+
+    client = get_instructor_client(genai)
+
+    system_message = {"role": "system", "content": CROSSOVER_PROMPT}
+    context_message = get_context_message(initial_prompt, improvement_request)
     user_message = {
         "role": "user",
         "content": f"Combine the following prompts into a better one:\n\n<prompt_1>\n{parent1.prompt}\n</prompt_1>\n\n<prompt_2>\n{parent2.prompt}\n</prompt_2>",
     }
 
     # Use instructor to handle the structured output
-    response = await client.chat.completions.create(
-        messages=[system_message, user_message],
-        model="gemini-2.0-flash",
+    response, token_count = await cached_completion(
+        client,
+        messages=[system_message, context_message, user_message],
+        model=MODEL,
         # temperature=1.0,
         response_model=PromptCrossover,
     )
 
-    # Get token usage from instructor response
-    token_usage = getattr(response, "usage", None)
-    if token_usage:
-        token_count = TokenCount(
-            token_usage.prompt_tokens, token_usage.completion_tokens
-        )
-    else:
-        token_count = TokenCount(0, 0)
+    semantic_cache.add(vector, (response.prompt,), parents)
 
     return PromptCandidate(response.prompt), token_count
@@ -1,16 +1,29 @@
 # Standard library
 import os
+import sys
+import json
+import asyncio
+import logging
+import shutil
+import hashlib
 import argparse
-import subprocess
-from typing import Optional, Tuple, Callable
+import importlib.util
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import Dict, List, Optional, Tuple, Callable
 
 # Local
 try:
     from promptimal.app import App
     from promptimal.dtos import PromptCandidate, TokenCount
+    from promptimal.optimizer.cache import CACHE_DIR, disable_disk_cache
+    from promptimal.optimizer.semantic_cache import save_semantic_caches
 except ImportError:
     from app import App
     from dtos import PromptCandidate, TokenCount
+    from optimizer.cache import CACHE_DIR, disable_disk_cache
+    from optimizer.semantic_cache import save_semantic_caches
 
 
 #########
@@ -18,83 +31,478 @@ except ImportError:
 #########
 
 
+logger = logging.getLogger("promptimal.evaluator")
+
+FITNESS_CACHE_SIZE = 4096  # Max. no. of evaluated prompts to remember
+MAX_ARG_SIZE = 64 * 1024  # Max. size of a prompt passed on the command line
+MAX_LINE_SIZE = 2**20  # Max. length of a line of evaluator output, in bytes
+STDERR_TAIL_SIZE = 4096  # Bytes of evaluator stderr to keep for diagnostics
+EVAL_CONCURRENCY = int(  # Max. no. of evaluator processes running at once
+    os.getenv("PROMPTIMAL_EVAL_CONCURRENCY", str(os.cpu_count() or 4))
+)
+
+# Environment variables passed to evaluator processes with --evaluator_minimal_env
+CHILD_ENV_KEYS = (
+    "PATH",
+    "HOME",
+    "LANG",
+    "LC_ALL",
+    "TMPDIR",
+    "SYSTEMROOT",  # Needed by Python on Windows
+    "VIRTUAL_ENV",
+    "GOOGLE_AI_API_KEY",
+    "GOOGLE_API_KEY",
+    "OPENAI_API_KEY",
+)
+
+
+def unescape_newlines(text: str) -> str:
+    # Skips the copy when there's nothing to replace. Interned, since prompts
+    # are hashed and compared as cache keys throughout
+    if "\\n" in text:
+        text = text.replace("\\n", "\n")
+
+    return sys.intern(text)
+
+
+class EvaluatorServer:
+    """
+    Pool of long-running evaluator processes, started with `--server`, so that
+    the interpreter and the evaluator's imports are loaded once per worker
+    instead of once per prompt. Prompts are written to a worker's stdin as JSON
+    lines, and each is answered with a score on its own line of stdout.
+    """
+
+    def __init__(
+        self, argv: List[str], num_workers: int, env: Optional[Dict[str, str]] = None
+    ):
+        self.argv = argv
+        self.num_workers = num_workers
+        self.env = env
+        self.idle_workers: Optional[asyncio.Queue] = None
+        self.workers: List[asyncio.subprocess.Process] = []
+        self.stderr_tasks: List[asyncio.Task] = []
+
+    async def _start_worker(self) -> asyncio.subprocess.Process:
+        worker = await asyncio.create_subprocess_exec(
+            *self.argv,
+            stdin=asyncio.subprocess.PIPE,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.PIPE,
+            env=self.env,
+        )
+        self.workers.append(worker)
+
+        # Drained continuously, so it neither fills up nor prints over the UI
+        async def log_stderr():
+            async for line in worker.stderr:
+                logger.debug("%s", line.decode(errors="replace").rstrip())
+
+        self.stderr_tasks.append(asyncio.ensure_future(log_stderr()))
+        return worker
+
+    async def close(self, timeout: float = 5.0):
+        # Workers exit once their stdin is closed. Any that don't are killed
+        for worker in self.workers:
+            if worker.returncode is None:
+                worker.stdin.close()
+
+        for worker in self.workers:
+            try:
+                await asyncio.wait_for(worker.wait(), timeout)
+            except asyncio.TimeoutError:
+                worker.kill()
+                await worker.wait()
+
+        await asyncio.gather(*self.stderr_tasks, return_exceptions=True)
+        self.idle_workers, self.workers, self.stderr_tasks = None, [], []
+
+    async def evaluate(self, prompt: str) -> Optional[float]:
+        if self.idle_workers is None:
+            # Workers are started lazily, on first use
+            self.idle_workers = asyncio.Queue()
+            for _ in range(self.num_workers):
+                self.idle_workers.put_nowait(None)
+
+        worker = await self.idle_workers.get()
+        try:
+            if worker is None or worker.returncode is not None:
+                worker = await self._start_worker()
+
+            worker.stdin.write(json.dumps({"prompt": prompt}).encode() + b"\n")
+            await worker.stdin.drain()
+
+            while True:
+                line = await worker.stdout.readline()
+                if not line:
+                    # Dead workers are restarted the next time they're used
+                    return_code = await worker.wait()
+                    logger.warning("Evaluator exited with return code: %s", return_code)
+                    score = None
+                    break
+
+                try:
+                    score = float(line)
+                    break
+                except ValueError:
+                    logger.debug("%s", line.decode(errors="replace").rstrip())
+        except BaseException:
+            # The worker may be mid-response, so replace it rather than reuse it
+            if worker is not None and worker.returncode is None:
+                worker.kill()
+            self.idle_workers.put_nowait(None)
+            raise
+
+        self.idle_workers.put_nowait(worker)
+        return score
+
+
+class EvaluatorBatcher:
+    """
+    Collects the prompts submitted within a short window (e.g. a generation's
+    candidates, which are evaluated concurrently) and scores them with a single
+    run of the evaluator, started with `--batch`. Prompts are written to its
+    stdin as `{"id", "prompt"}` JSON lines, and it answers with `{"id", "score"}`
+    JSON lines on stdout.
+    """
+
+    def __init__(
+        self,
+        argv: List[str],
+        env: Optional[Dict[str, str]] = None,
+        window: float = 0.01,
+    ):
+        self.argv = argv
+        self.env = env
+        self.window = window  # Seconds to wait for more prompts
+        self.pending: List[Tuple[str, asyncio.Future]] = []
+        self.flush_task: Optional[asyncio.Task] = None
+
+    async def evaluate(self, prompt: str) -> Optional[float]:
+        loop = asyncio.get_running_loop()
+        if not self.pending:
+            loop.call_later(self.window, self._start_flush)
+
+        future = loop.create_future()
+        self.pending.append((prompt, future))
+        return await future
+
+    def _start_flush(self):
+        # Keep a reference, so the task isn't garbage collected while running
+        self.flush_task = asyncio.ensure_future(self._flush())
+
+    async def _flush(self):
+        batch, self.pending = self.pending, []
+        try:
+            scores = await self._run([prompt for prompt, _ in batch])
+        except Exception as e:
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+
+        for index, (_, future) in enumerate(batch):
+            if not future.done():
+                future.set_result(scores.get(index))
+
+    async def _run(self, prompts: List[str]) -> Dict[int, float]:
+        process = await asyncio.create_subprocess_exec(
+            *self.argv,
+            stdin=asyncio.subprocess.PIPE,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.PIPE,
+            env=self.env,
+        )
+        requests = "".join(
+            json.dumps({"id": index, "prompt": prompt}) + "\n"
+            for index, prompt in enumerate(prompts)
+        )
+        stdout, stderr = await process.communicate(requests.encode())
+
+        if stderr:
+            logger.debug("Evaluator stderr:\n%s", stderr.decode(errors="replace"))
+        if process.returncode != 0:
+            logger.warning("Evaluator failed with return code: %s", process.returncode)
+            return {}
+
+        # Prompts without a valid score are treated as failed evaluations
+        scores = {}
+        for line in stdout.decode(errors="replace").splitlines():
+            try:
+                result = json.loads(line)
+                scores[int(result["id"])] = float(result["score"])
+            except (ValueError, TypeError, KeyError):
+                if line.strip():
+                    logger.debug("%s", line)  # Evaluator logs
+
+        return scores
+
+
+def load_evaluator_function(evaluator_path: str) -> Callable[[str], float]:
+    """
+    Imports the evaluator script as a module and returns its `evaluator`
+    function, without running the script's `main`.
+    """
+    # Registered under a unique name before it runs, since e.g. dataclasses look
+    # their module up in sys.modules
+    path_hash = hashlib.blake2b(evaluator_path.encode(), digest_size=8).hexdigest()
+    name = f"_promptimal_evaluator_{path_hash}"
+    spec = importlib.util.spec_from_file_location(name, evaluator_path)
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    try:
+        spec.loader.exec_module(module)
+    except BaseException:
+        del sys.modules[name]
+        raise
+
+    return module.evaluator
+
+
+_evaluator_function = None  # Loaded once in each pool worker
+
+
+def _init_pool_worker(evaluator_path: str):
+    global _evaluator_function
+    _evaluator_function = load_evaluator_function(evaluator_path)
+
+
+def _call_evaluator_function(prompt: str) -> float:
+    return float(_evaluator_function(prompt))
+
+
 def generate_evaluator(
-    evaluator_path: Optional[str], evaluator_python_path: Optional[str]
+    evaluator_path: Optional[str],
+    evaluator_python_path: Optional[str],
+    mode: str = "script",
+    minimal_env: bool = False,
+    long_prompts_via_stdin: bool = False,
 ) -> Optional[Callable]:
     if not evaluator_path:
         return None
 
     if not evaluator_python_path:
         # Fallback to current Python interpreter if not specified
-        import sys
-
         evaluator_python_path = sys.executable
 
+    # Resolve the paths once, so that spawns don't search $PATH, and aren't
+    # affected if the working directory changes later
+    evaluator_path = os.path.abspath(evaluator_path)
+    evaluator_python_path = os.path.abspath(
+        shutil.which(evaluator_python_path) or evaluator_python_path
+    )
+    argv_prefix = (evaluator_python_path, evaluator_path, "--prompt")
+
+    # Evaluator processes inherit the whole environment, unless asked not to
+    env = None
+    if minimal_env:
+        env = {key: os.environ[key] for key in CHILD_ENV_KEYS if key in os.environ}
+
+    server = None
+    if mode == "server":
+        server = EvaluatorServer(
+            [evaluator_python_path, "-u", evaluator_path, "--server"],
+            num_workers=EVAL_CONCURRENCY,
+            env=env,
+        )
+
+    batcher = None
+    if mode == "batch":
+        batcher = EvaluatorBatcher(
+            [evaluator_python_path, "-u", evaluator_path, "--batch"], env=env
+        )
+
+    # The pool and import modes load the script into this interpreter, so fall
+    # back to running it as a script if it needs another one. Paths aren't
+    # resolved, since a venv's python symlinks to the base interpreter but has
+    # its own site-packages
+    can_import = (
+        evaluator_path.endswith(".py")
+        and os.path.isfile(evaluator_path)
+        and evaluator_python_path == os.path.abspath(sys.executable)
+    )
+    if mode in ("pool", "import") and not can_import:
+        logger.warning("Evaluator can't be imported, running it as a script instead.")
+
+    pool = None
+    if mode == "pool" and can_import:
+        pool = ProcessPoolExecutor(
+            max_workers=EVAL_CONCURRENCY,
+            initializer=_init_pool_worker,
+            initargs=(evaluator_path,),
+        )
+
+    evaluator_function = None
+    if mode == "import" and can_import:
+        try:
+            evaluator_function = load_evaluator_function(evaluator_path)
+        except (Exception, SystemExit) as e:
+            # E.g. the script has no __main__ guard, and tried to parse our args
+            logger.warning(
+                "Evaluator can't be imported (%r), running it as a script instead.", e
+            )
+
+    # Keeps a large generation from running more evaluations at once than there
+    # are cores (as scripts, or as threads in import mode)
+    eval_semaphore = asyncio.Semaphore(EVAL_CONCURRENCY)
+
+    async def run_script(prompt: str) -> Optional[float]:
+        logger.debug("Running evaluator with prompt:\n%s", prompt)
+
+        # If the script supports it, prompts too long for the command line (see
+        # ARG_MAX) are piped to its stdin instead, signalled by `--prompt -`
+        encoded_prompt = prompt.encode()
+        use_stdin = long_prompts_via_stdin and len(encoded_prompt) > MAX_ARG_SIZE
+
+        # Run without blocking the event loop, so that other candidates (and
+        # the UI) make progress while the evaluator works
+        process = await asyncio.create_subprocess_exec(
+            *argv_prefix,
+            "-" if use_stdin else prompt,
+            stdin=asyncio.subprocess.PIPE if use_stdin else None,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.PIPE,
+            limit=MAX_LINE_SIZE,
+            env=env,
+        )
+
+        async def write_stdin():
+            if use_stdin:
+                process.stdin.write(encoded_prompt)
+                await process.stdin.drain()
+                process.stdin.close()
+
+        # Stream the output instead of buffering all of it, keeping only the
+        # last non-empty line of stdout (the score) and the tail of stderr
+        async def read_stdout() -> str:
+            last_line = ""
+            async for line in process.stdout:
+                line = line.decode(errors="replace").strip()
+                if line:
+                    logger.debug("%s", line)
+                    last_line = line
+
+            return last_line
+
+        async def read_stderr() -> str:
+            tail = b""
+            async for line in process.stderr:
+                tail = (tail + line)[-STDERR_TAIL_SIZE:]
+
+            return tail.decode(errors="replace")
+
+        try:
+            _, last_line, stderr = await asyncio.gather(
+                write_stdin(), read_stdout(), read_stderr()
+            )
+            await process.wait()
+        finally:
+            # E.g. an overlong line of output, or the run was cancelled. Don't
+            # leave the evaluator running, or blocked on a full pipe
+            if process.returncode is None:
+                process.kill()
+                await process.wait()
+
+        if stderr:
+            logger.debug("Evaluator stderr:\n%s", stderr.strip())
+
+        if process.returncode != 0:
+            logger.warning("Evaluator failed with return code: %s", process.returncode)
+            return None
+
+        if not last_line:
+            logger.warning("No output from evaluator")
+            return None
+
+        try:
+            # Try to convert the last line to float
+            fitness = float(last_line)
+            logger.debug("Extracted fitness score: %s", fitness)
+            return fitness
+        except ValueError:
+            logger.warning("Could not convert evaluator output to float: %s", last_line)
+            return None
+
+    async def score(prompt: str) -> Optional[float]:
+        nonlocal pool
+        if pool:
+            try:
+                loop = asyncio.get_running_loop()
+                return await loop.run_in_executor(
+                    pool, _call_evaluator_function, prompt
+                )
+            except BrokenProcessPool:
+                # Importing the script failed (e.g. it has no __main__ guard)
+                if pool:
+                    logger.warning(
+                        "Evaluator can't be imported, running it as a script instead."
+                    )
+                    pool = None
+
+        if evaluator_function:
+            async with eval_semaphore:
+                if asyncio.iscoroutinefunction(evaluator_function):
+                    return float(await evaluator_function(prompt))
+
+                # Run in a thread, so a slow evaluator doesn't block the event loop
+                loop = asyncio.get_running_loop()
+                return float(
+                    await loop.run_in_executor(None, evaluator_function, prompt)
+                )
+
+        if server:
+            return await server.evaluate(prompt)
+
+        if batcher:
+            return await batcher.evaluate(prompt)
+
+        async with eval_semaphore:
+            return await run_script(prompt)
+
+    # Fitnesses of previously evaluated prompts, least recently used first. The
+    # evaluator is assumed to be deterministic, so repeats needn't be re-run.
+    fitness_cache: OrderedDict[bytes, float] = OrderedDict()
+
     async def evaluator(
         candidate: PromptCandidate, *args
     ) -> Tuple[PromptCandidate, TokenCount]:
-        if candidate.fitness != None:
+        if candidate.fitness is not None:
+            return candidate, TokenCount(0, 0)
+
+        key = hashlib.blake2b(candidate.prompt.encode(), digest_size=16).digest()
+        if key in fitness_cache:
+            fitness_cache.move_to_end(key)
+            candidate.fitness = fitness_cache[key]
             return candidate, TokenCount(0, 0)
 
         try:
-            print("\n" + "=" * 50)
-            print(f"Running evaluator with prompt:\n{candidate.prompt}")
-            print("=" * 50)
-
-            result = subprocess.run(
-                [
-                    str(evaluator_python_path),
-                    str(evaluator_path),
-                    "--prompt",
-                    candidate.prompt,
-                ],
-                capture_output=True,
-                text=True,
-                check=False,
-            )
+            fitness = await score(candidate.prompt)
+        except Exception as e:
+            logger.exception("Exception in evaluator: %s", e)
+            fitness = None
 
-            # Always print stdout if there is any
-            if result.stdout:
-                print("\nEvaluator stdout:")
-                print("-" * 20)
-                print(result.stdout.strip())
-
-            # Always print stderr if there is any
-            if result.stderr:
-                print("\nEvaluator stderr:")
-                print("-" * 20)
-                print(result.stderr.strip())
-
-            if result.returncode != 0:
-                print(f"\nEvaluator failed with return code: {result.returncode}")
-                candidate.fitness = 0.0
-            else:
-                # Get the last non-empty line from stdout
-                output_lines = [
-                    line.strip() for line in result.stdout.split("\n") if line.strip()
-                ]
-                if not output_lines:
-                    print("\nNo output from evaluator")
-                    candidate.fitness = 0.0
-                else:
-                    try:
-                        # Try to convert the last line to float
-                        candidate.fitness = float(output_lines[-1])
-                        print(f"\nExtracted fitness score: {candidate.fitness}")
-                    except ValueError:
-                        print(
-                            f"\nCould not convert evaluator output to float: {output_lines[-1]}"
-                        )
-                        candidate.fitness = 0.0
-
-            print("=" * 50 + "\n")
+        if fitness is None:
+            candidate.fitness = 0.0  # Not cached, so it's retried if seen again
+            return candidate, TokenCount(0, 0)
 
-        except Exception as e:
-            print(f"Exception in evaluator: {str(e)}")
-            candidate.fitness = 0.0
+        candidate.fitness = fitness
+        fitness_cache[key] = fitness
+        if len(fitness_cache) > FITNESS_CACHE_SIZE:
+            fitness_cache.popitem(last=False)
 
         return candidate, TokenCount(0, 0)
 
+    async def aclose():
+        # Stops any evaluator processes still running, once the run is over
+        if server:
+            await server.close()
+        if pool:
+            loop = asyncio.get_running_loop()
+            await loop.run_in_executor(
+                None, lambda: pool.shutdown(wait=True, cancel_futures=True)
+            )
+
+    evaluator.aclose = aclose
     return evaluator
 
 
@@ -103,7 +511,10 @@ def generate_evaluator(
 ######
 
 
-def main():
+LOG_FILE = os.getenv("PROMPTIMAL_LOG_FILE", os.path.join(CACHE_DIR, "promptimal.log"))
+
+
+def get_parser() -> argparse.ArgumentParser:
     parser = argparse.ArgumentParser(
         description="Optimize your prompts using a genetic algorithm."
     )
@@ -147,7 +558,7 @@ def main():
         default="",
         required=False,
         type=str,
-        help="Google AI API key.",
+        help="Google AI API key. Defaults to the GOOGLE_AI_API_KEY environment variable.",
     )
     parser.add_argument(
         "--evaluator",
@@ -163,32 +574,102 @@ def main():
         type=str,
         help="Path to the Python interpreter to use for the evaluator script (e.g. /path/to/venv/bin/python).",
     )
-    args = parser.parse_args()
+    parser.add_argument(
+        "--evaluator_mode",
+        default="script",
+        required=False,
+        choices=["script", "server", "batch", "pool", "import"],
+        help="How to run the evaluator: as a script per prompt, as long-running processes driven over stdin (the script must support --server), once per generation (the script must support --batch), or by importing its evaluator function into a process pool, or into promptimal itself.",
+    )
+    parser.add_argument(
+        "--evaluator_minimal_env",
+        action="store_true",
+        help="Only pass essential environment variables (PATH, HOME, locale, API keys) to evaluator processes.",
+    )
+    parser.add_argument(
+        "--evaluator_stdin",
+        action="store_true",
+        help="Pipe prompts too long for the command line to the evaluator script's stdin, passing `--prompt -` (the script must support this).",
+    )
+    parser.add_argument(
+        "--no_cache",
+        action="store_true",
+        help="Don't reuse (or save) LLM responses cached by previous runs.",
+    )
+    parser.add_argument(
+        "--verbose",
+        action="store_true",
+        help="Log evaluator output and diagnostics to PROMPTIMAL_LOG_FILE (default: ~/.cache/promptimal/promptimal.log). Or set PROMPTIMAL_LOG to a log level.",
+    )
+    return parser
 
-    # if not os.getenv("OPENAI_API_KEY", None) or args.openai_api_key:
-    #     print("\033[1;31mOpenAI API key not found.\033[0m")
-    #     return
 
-    init_prompt = (
+def configure_logging(level_name: Optional[str]):
+    # Only configures promptimal's own loggers, so that httpx etc. stay quiet.
+    # Records go to a file, since anything printed would draw over the UI
+    level = logging.getLevelName((level_name or "WARNING").upper())
+    if not isinstance(level, int):
+        print(f"\033[1;31mUnknown log level: {level_name}\033[0m")
+        level = logging.WARNING
+
+    package_logger = logging.getLogger("promptimal")
+    package_logger.setLevel(level)
+    package_logger.propagate = False
+
+    try:
+        os.makedirs(os.path.dirname(LOG_FILE) or ".", exist_ok=True)
+        handler = logging.FileHandler(LOG_FILE, delay=True)
+        handler.setFormatter(
+            logging.Formatter("%(asctime)s %(levelname)s %(name)s: %(message)s")
+        )
+    except OSError:
+        handler = logging.NullHandler()
+    package_logger.addHandler(handler)
+
+
+def main():
+    args = get_parser().parse_args()
+
+    configure_logging("DEBUG" if args.verbose else os.getenv("PROMPTIMAL_LOG"))
+
+    if args.no_cache:
+        disable_disk_cache()
+
+    api_key = args.google_ai_api_key or os.getenv("GOOGLE_AI_API_KEY")
+    if not api_key:
+        print("\033[1;31mGoogle AI API key not found.\033[0m")
+        return
+
+    init_prompt = unescape_newlines(
         input("\033[1;90mInitial prompt (use \\n for newlines):\033[0m\n\n")
         if not args.prompt
         else args.prompt
-    ).replace("\\n", "\n")
-    improvement_request = (
+    )
+    improvement_request = unescape_newlines(
         input("\n\033[1;90mWhat do you want to improve:\033[0m\n\n")
         if not args.improve
         else args.improve
-    ).replace("\\n", "\n")
+    )
 
+    evaluator = generate_evaluator(
+        args.evaluator,
+        args.evaluator_python_path,
+        args.evaluator_mode,
+        args.evaluator_minimal_env,
+        args.evaluator_stdin,
+    )
     app = App(init_prompt)
     optimized_prompt, is_finished = app.start(
         improvement_request=improvement_request,
         num_iters=args.num_iters,
         population_size=args.num_samples,
         threshold=args.threshold,
-        api_key=args.google_ai_api_key,
-        evaluator=generate_evaluator(args.evaluator, args.evaluator_python_path),
+        api_key=api_key,
+        evaluator=evaluator,
     )
+    if evaluator:
+        asyncio.get_event_loop().run_until_complete(evaluator.aclose())
+    save_semantic_caches()  # In case the run was quit early
 
     if args.prompt:
         print(f"\033[1;90mInitial prompt:\033[0m\n\n{init_prompt}")
@@ -201,4 +682,8 @@ def main():
             f"\n🧬 \033[1;35mOPTIMIZED PROMPT\033[0m 🧬\n\n\033[35m{optimized_prompt}\033[0m"
         )
     else:
-        print(f"\n\033[1;31mOptimization loop terminated.\033[0m")
+        print("\n\033[1;31mOptimization loop terminated.\033[0m")
+
+
+if __name__ == "__main__":
+    main()